@@ -1,109 +1,889 @@
+#!/usr/bin/env python3
+"""
+Convert a YOLOv7 .pt checkpoint to TorchScript (and optionally ONNX, FP16/BF16,
+INT8 and TensorRT variants) for the Rust detector.
+
+Two modes are available as subcommands:
+
+    raw  - the model's decoded predictions, [batch, anchors, 5 + classes]
+    nms  - post-processed detections, [K, 6] = [x1, y1, x2, y2, conf, class_id]
+"""
 import torch
 import torch.serialization
+import argparse
+import copy
+import glob
+import hashlib
+import importlib.util
+import io
+import json
+import platform
 import sys
 import os
+from pathlib import Path
+from typing import Final, List, Tuple
+
+
+def setup_yolo_import_path(model_path):
+    """
+    Make the YOLOv7 ``models`` package importable for unpickling the checkpoint.
+    
+    Candidates are $YOLOV7_PATH, the parent of this repository, its ``prb``
+    checkout and the checkpoint's directory. They are added in one
+    ``sys.path`` assignment, with a single import cache invalidation.
+    Returns False if $YOLOV7_PATH is set but is not a directory, or if
+    ``models`` still cannot be found.
+    """
+    yolov7_path = os.environ.get("YOLOV7_PATH")
+    if yolov7_path and not os.path.isdir(yolov7_path):
+        # Don't silently fall back to whichever other ``models`` package is found
+        print(f"Error: YOLOv7 directory not found at YOLOV7_PATH={yolov7_path}")
+        return False
+    
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    candidates = [yolov7_path, repo_root, os.path.join(repo_root, "prb"),
+                  os.path.dirname(os.path.abspath(model_path))]
+    new_paths = [p for p in dict.fromkeys(candidates) if p and os.path.isdir(p) and p not in sys.path]
+    if new_paths:
+        sys.path[:0] = new_paths
+        importlib.invalidate_caches()
+    for path in new_paths:
+        print(f"Added to Python path: {path}")
+    
+    if importlib.util.find_spec("models") is None:
+        print("Error: YOLOv7 modules are not importable; set YOLOV7_PATH to the YOLOv7 repository")
+        return False
+    return True
+
+
+def yolo_module_classes():
+    """Module classes a pickled YOLOv7 checkpoint may reference: torch.nn plus the YOLOv7 layers."""
+    namespaces = [torch.nn]
+    try:
+        import models.common
+        import models.experimental
+        import models.yolo
+        namespaces += [models.common, models.experimental, models.yolo]
+    except ImportError as e:
+        print(f"Could not import YOLOv7 layer definitions: {e}")
+    return [obj for ns in namespaces for obj in vars(ns).values()
+            if isinstance(obj, type) and issubclass(obj, torch.nn.Module)]
+
+
+def numpy_checkpoint_globals():
+    """
+    NumPy globals stock YOLOv7 checkpoints pickle, e.g. the ``best_fitness`` array train.py stores.
+    
+    Checkpoints written with NumPy 1.x reference ``numpy.core``, which NumPy 2
+    renamed to ``numpy._core``, so the old names are registered as aliases.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        return []
+    multiarray = np._core.multiarray if hasattr(np, '_core') else np.core.multiarray
+    safe = [multiarray._reconstruct, multiarray.scalar, np.ndarray, np.dtype, type(np.dtype(np.float64))]
+    if multiarray.__name__ != 'numpy.core.multiarray':
+        safe += [(multiarray._reconstruct, 'numpy.core.multiarray._reconstruct'),
+                 (multiarray.scalar, 'numpy.core.multiarray.scalar')]
+    return safe
+
+
+def load_yolo_model(model_path):
+    """
+    Load the model from a YOLO checkpoint with a single ``torch.load`` call.
+    
+    Only module classes from ``yolo_module_classes`` and the NumPy types from
+    ``numpy_checkpoint_globals`` are trusted by the ``weights_only`` unpickler,
+    and tensor storages are memory-mapped rather than copied into RAM.
+    """
+    torch.serialization.add_safe_globals(yolo_module_classes() + numpy_checkpoint_globals())
+    ckpt = torch.load(model_path, map_location='cpu', weights_only=True, mmap=True)
+    model = (ckpt.get('ema') or ckpt.get('model') or ckpt) if isinstance(ckpt, dict) else ckpt
+    if not isinstance(model, torch.nn.Module):
+        raise ValueError("Checkpoint doesn't contain a model or EMA (a state_dict needs the model definition)")
+    
+    # Same post-load steps as YOLOv7's attempt_load (.float().fuse().eval()):
+    # stock checkpoints are saved in half precision, and fuse_conv_and_bn mixes
+    # the weights with float32 zero biases, so cast before fusing Conv-BN.
+    # Also patch Upsample modules pickled with older PyTorch versions
+    model = model.float()
+    if hasattr(model, 'fuse'):
+        model = model.fuse()
+    for m in model.modules():
+        if isinstance(m, torch.nn.Upsample):
+            m.recompute_scale_factor = None
+    return model.eval().requires_grad_(False)
+
+
+def materialize_detect_grids(model, input_size=640, dtype=None, device=None):
+    """
+    Build the YOLOv7 detection heads' lazily created grids for ``input_size``.
+    
+    Detect only builds ``grid[i]`` on its first forward; building it here
+    replaces the warm-up forward pass and lets the tracer record the grids as
+    constants instead of re-creating them on every call. Returns the number
+    of heads initialized.
+    """
+    heads = 0
+    for m in model.modules():
+        if not (hasattr(m, '_make_grid') and hasattr(m, 'grid') and hasattr(m, 'stride')):
+            continue
+        for i, stride in enumerate(m.stride.tolist()):
+            n = input_size // int(stride)
+            m.grid[i] = m._make_grid(n, n).to(device=device, dtype=dtype)
+        heads += 1
+    return heads
+
+
+def xywh_to_xyxy(boxes: torch.Tensor) -> torch.Tensor:
+    """Convert [..., (cx, cy, w, h)] boxes to [..., (x1, y1, x2, y2)] in one fused op."""
+    xy = boxes[..., 0:2]
+    half_wh = boxes[..., 2:4] * 0.5
+    return torch.cat([xy - half_wh, xy + half_wh], dim=-1)
+
+
+def batched_nms(boxes: torch.Tensor, scores: torch.Tensor, idxs: torch.Tensor, iou_thresh: float,
+                max_candidates: int = 3000) -> torch.Tensor:
+    """
+    Class-aware greedy NMS from aten ops only, returning kept indices in descending score order.
+    
+    Same result as ``torchvision.ops.batched_nms`` for up to ``max_candidates``
+    boxes (lower-scoring ones are dropped first), without its
+    ``torchvision::nms`` custom op: the Rust side only links libtorch, which
+    cannot load a graph that calls it.
+    """
+    order = torch.argsort(scores, descending=True)[:max_candidates]
+    if order.numel() == 0:
+        return order
+    # Shift each index group to its own region so boxes of different groups never overlap
+    offsets = idxs[order].to(boxes.dtype) * (boxes.max() + 1)
+    b = boxes[order] + offsets.unsqueeze(1)
+    
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    lt = torch.max(b[:, None, :2], b[None, :, :2])
+    rb = torch.min(b[:, None, 2:], b[None, :, 2:])
+    inter = (rb - lt).clamp(min=0).prod(dim=2)
+    iou = inter / (area[:, None] + area[None, :] - inter)
+    # suppresses[i, j]: the higher-scoring box i would suppress box j
+    suppresses = torch.triu(iou > iou_thresh, diagonal=1)
+    
+    # Greedy NMS keeps a box iff no kept higher-scoring box suppresses it. Iterate
+    # that rule from "keep all" to its fixed point, which is the greedy result;
+    # every pass fixes at least one more box in score order, usually a handful suffice
+    keep = torch.ones_like(order, dtype=torch.bool)
+    for _ in range(order.numel()):
+        new_keep = ~(suppresses & keep.unsqueeze(1)).any(dim=0)
+        if bool((new_keep == keep).all()):
+            break
+        keep = new_keep
+    return order[keep]
+
+
+class YoloExportWrapper(torch.nn.Module):
+    """
+    A wrapper class to match the output format expected by the Rust code.
+    
+    With ``include_nms`` the raw YOLO output is post-processed into
+    [x1, y1, x2, y2, conf, class_id] rows; otherwise the decoded predictions
+    [batch, anchors, 5 + classes] are returned as is. ``out_format`` selects
+    whether boxes are written as corners ('xyxy') or centre/size ('xywh').
+    """
+    include_nms: Final[bool]
+    out_format: Final[str]
+    
+    def __init__(self, model, include_nms=False, conf_thresh=0.25, iou_thresh=0.45, out_format='xywh'):
+        super().__init__()
+        self.model = model
+        self.include_nms = include_nms
+        self.conf_thresh = conf_thresh
+        self.iou_thresh = iou_thresh
+        self.out_format = out_format
+    
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # YOLO inference returns different formats depending on the model
+        out = self.model(x)
+        if torch.jit.isinstance(out, Tuple[torch.Tensor, torch.Tensor]):
+            # Model likely returns both raw output and processed boxes
+            if self.include_nms:
+                return out[1]
+            pred = out[0]
+        elif torch.jit.isinstance(out, Tuple[torch.Tensor, List[torch.Tensor]]):
+            # YOLOv7 inference output: (detections, per-level feature maps)
+            pred = out[0]
+        elif torch.jit.isinstance(out, List[torch.Tensor]):
+            # Some models return a list of tensors
+            pred = out[0]
+        else:
+            # Single tensor output
+            pred = out
+        
+        if self.include_nms:
+            return self._process_raw_output(pred)
+        if self.out_format == 'xyxy':
+            return torch.cat([xywh_to_xyxy(pred), pred[..., 4:]], dim=-1)
+        return pred
+    
+    def _process_raw_output(self, output: torch.Tensor) -> torch.Tensor:
+        """Process the raw YOLO output to get boxes in [x1, y1, x2, y2, conf, class_id] format."""
+        
+        # This assumes raw output in format [batch, anchors, 5+classes]
+        # where 5 = [x, y, w, h, obj_conf]
+        batch_size = output.shape[0]
+        num_anchors = output.shape[1]
+        num_classes = output.shape[2] - 5
+        
+        # Convert to corner format in one fused op
+        xyxy = xywh_to_xyxy(output)
+        
+        # Combine object confidence with the best class score and keep its ID
+        # (a single max reduction yields both the score and the index)
+        max_scores, cls_indices = output[..., 5:].max(dim=-1)
+        scores = output[..., 4] * max_scores
+        
+        # Filter by confidence threshold across the whole batch at once
+        mask = scores > self.conf_thresh
+        batch_idx = torch.arange(batch_size, device=output.device).unsqueeze(1).expand(batch_size, num_anchors)
+        image_idx = batch_idx[mask]
+        boxes = xyxy[mask]
+        scores = scores[mask]
+        cls_indices = cls_indices[mask]
+        
+        # Class-aware NMS over the whole batch at once; offsetting the class
+        # index by the image index keeps images in the batch independent
+        keep = batched_nms(boxes, scores, image_idx * num_classes + cls_indices, self.iou_thresh)
+        
+        # Group the kept boxes by image (score order within each image) with one
+        # index gather, so the (K, 6) result needs no per-image list and concat
+        # (image * K + rank keys are unique, so a plain argsort keeps score order)
+        kept_images = image_idx[keep]
+        rank = torch.arange(kept_images.numel(), device=output.device)
+        keep = keep[torch.argsort(kept_images * kept_images.numel() + rank)]
+        
+        boxes = boxes[keep]
+        if self.out_format == 'xywh':
+            boxes = torch.cat([(boxes[:, 0:2] + boxes[:, 2:4]) * 0.5, boxes[:, 2:4] - boxes[:, 0:2]], dim=1)
+        return torch.cat([
+            boxes,
+            scores[keep].unsqueeze(-1),
+            cls_indices[keep].float().unsqueeze(-1)
+        ], dim=1)
+
+
+def script_wrapper(model, example_input, wrapper_options):
+    """
+    Script a YoloExportWrapper built from ``wrapper_options`` around ``model``.
+    
+    YOLOv7's own forward is not scriptable, so the model is traced and only the
+    wrapper (output handling and NMS) is scripted around it. If scripting
+    fails, the whole wrapper is traced instead.
+    """
+    traced_backbone = torch.jit.trace(model, example_input, strict=False)
+    # Freezing requires the scripted module itself to be in eval mode
+    try:
+        return torch.jit.script(YoloExportWrapper(traced_backbone, **wrapper_options).eval())
+    except Exception as e:
+        print(f"Scripting failed, falling back to tracing: {e}")
+        return torch.jit.trace(YoloExportWrapper(model, **wrapper_options).eval(), example_input)
+
+
+# Memory layouts the TorchScript graph can be captured in
+MEMORY_FORMATS = {
+    'nhwc': torch.channels_last,
+    'nchw': torch.contiguous_format,
+}
+
+
+def test_run(script_model, example_input):
+    """
+    Run the scripted module once before it is saved and log its output shape.
+    
+    This runs regardless of ``--optimize``, so a module that cannot execute is
+    never written; any error propagates and fails the conversion.
+    """
+    with torch.inference_mode():
+        output = script_model(example_input)
+    print(f"Test run successful, output shape: {output.shape}")
+
+
+def save_torchscript(script_model, dummy_input, output_path, freeze=True, optimize=True, check_iters=5):
+    """
+    Freeze and optimize a TorchScript module for inference, check that it runs and save it.
+    
+    The optimized graph is specialized for the shape of ``dummy_input``
+    (1x3x640x640): the Rust side must feed the same fixed input size.
+    If the optimized module cannot be saved, or the saved file cannot be
+    loaded back and run, the frozen-only module is saved instead.
+    """
+    # Freeze the graph: inlines parameters as constants, folds Conv-BN
+    # and strips dropout so every downstream inference runs fewer ops
+    if freeze:
+        try:
+            script_model = torch.jit.freeze(script_model)
+            print("Model frozen")
+        except RuntimeError as e:
+            print(f"Freezing failed, saving unfrozen model: {e}")
+            optimize = False
+    
+    optimized_model = None
+    if freeze and optimize:
+        try:
+            # optimize_for_inference rewrites an already frozen module's graph in
+            # place, and copies of a ScriptModule share their graphs; optimize an
+            # independent reloaded copy so the frozen fallback below stays untouched
+            buffer = io.BytesIO()
+            torch.jit.save(script_model, buffer)
+            buffer.seek(0)
+            optimized_model = torch.jit.optimize_for_inference(torch.jit.load(buffer))
+            # Run the production input shape a few times so a failure in the
+            # optimized graph surfaces here rather than at deployment. This is a
+            # smoke test only: the profiling executor's shape specializations
+            # are runtime state that save() does not serialize, so the Rust
+            # side still pays the first-call optimization cost
+            with torch.inference_mode(), torch.jit.optimized_execution(True):
+                for _ in range(check_iters):
+                    optimized_model(dummy_input)
+            print("Model optimized for inference")
+        except Exception as e:
+            print(f"optimize_for_inference failed, keeping frozen model: {e}")
+            optimized_model = None
+    
+    if optimized_model is not None:
+        try:
+            optimized_model.save(output_path)
+            # Saving can succeed on graphs that cannot be deserialized (e.g. the
+            # prim::ConstantMKLDNNTensor weights of the MKLDNN conv path), so
+            # load the file back and run it as the Rust side would
+            with torch.inference_mode():
+                torch.jit.load(output_path)(dummy_input)
+            return
+        except Exception as e:
+            print(f"Optimized model does not save and reload, saving frozen model instead: {e}")
+    script_model.save(output_path)
+
+
+def export_onnx(model, dummy_input, output_path, opset_version=17):
+    """
+    Export ``model`` to ONNX next to the TorchScript artifact for ONNX Runtime/OpenVINO.
+    
+    ``model`` should be the scripted wrapper: the TorchScript-based exporter
+    turns the NMS loop into an ONNX Loop, where tracing would unroll it for the
+    dummy input. ``torch.export`` (the default exporter since PyTorch 2.9)
+    cannot handle the data-dependent NMS output size. A half-precision ``.fp16.onnx`` copy is also written when ``onnx`` and
+    ``onnxconverter_common`` are installed.
+    """
+    onnx_path = str(Path(output_path).with_suffix('.onnx'))
+    torch.onnx.export(model, dummy_input, onnx_path, opset_version=opset_version,
+                      input_names=['images'], output_names=['dets'],
+                      dynamic_axes={'images': {0: 'batch'}}, dynamo=False)
+    print(f"ONNX model saved to {onnx_path}")
+    
+    try:
+        import onnx
+        from onnxconverter_common import float16
+    except ImportError as e:
+        print(f"Skipping FP16 ONNX export: {e}")
+        return
+    fp16_path = str(Path(output_path).with_suffix('.fp16.onnx'))
+    onnx.save(float16.convert_float_to_float16(onnx.load(onnx_path)), fp16_path)
+    print(f"FP16 ONNX model saved to {fp16_path}")
+
+
+OUTPUT_FORMATS = ('ts', 'onnx')
+
+
+def parse_formats(value):
+    """Parse a comma-separated ``--formats`` value such as ``ts,onnx``."""
+    formats = [f.strip() for f in value.split(',') if f.strip()]
+    unknown = sorted(set(formats) - set(OUTPUT_FORMATS))
+    if not formats or unknown:
+        raise argparse.ArgumentTypeError(
+            f"invalid format(s) {', '.join(unknown) or value!r}; choose from {', '.join(OUTPUT_FORMATS)}")
+    return formats
+
+
+# Reduced-precision variants: dtype and suffix of the extra artifact
+PRECISION_VARIANTS = {
+    'fp16': (torch.half, '.fp16.ts'),
+    'bf16': (torch.bfloat16, '.bf16.ts'),
+}
+
+
+def export_reduced_precision(model, dummy_input, output_path, precision, wrapper_options,
+                             freeze=True, optimize=True, tolerance=1e-2):
+    """
+    Save a half (fp16) or bfloat16 (bf16) copy of the model next to the FP32 artifact.
+    
+    The model and the dummy input are cast together so no "expected Float but
+    found Half" mismatch occurs. The raw predictions (before any NMS, whose
+    box count may legitimately differ) are compared against the FP32 model on
+    a fixed random image and the variant is only written if they stay within
+    ``tolerance``.
+    """
+    dtype, suffix = PRECISION_VARIANTS[precision]
+    variant_path = str(Path(output_path).with_suffix(suffix))
+    
+    # Cast a copy so the FP32 model stays untouched
+    low_model = copy.deepcopy(model).to(dtype)
+    materialize_detect_grids(low_model, dummy_input.shape[-1], dtype=dtype)
+    low_input = dummy_input.to(dtype)
+    
+    # dummy_input is uninitialized memory, so compare on a seeded random image
+    check_input = torch.empty_like(dummy_input).uniform_(0, 1, generator=torch.Generator().manual_seed(0))
+    with torch.inference_mode():
+        reference = YoloExportWrapper(model)(check_input)
+        low_output = YoloExportWrapper(low_model)(check_input.to(dtype))
+    if low_output.dtype != dtype:
+        print(f"Warning: {precision} model returned {low_output.dtype} output")
+    max_diff = (low_output.float() - reference.float()).abs().max().item()
+    if not torch.allclose(low_output.float(), reference.float(), rtol=tolerance, atol=tolerance):
+        print(f"Error: {precision} output differs from FP32 (max abs diff {max_diff:.4g}), "
+              f"not saving {variant_path}")
+        return False
+    print(f"{precision} output matches FP32 (max abs diff {max_diff:.4g})")
+    
+    scripted_low = script_wrapper(low_model, low_input, wrapper_options)
+    save_torchscript(scripted_low, low_input, variant_path, freeze=freeze, optimize=optimize)
+    print(f"{precision} TorchScript model saved to {variant_path}")
+    return True
 
-# Add YOLOv7 directory to Python path
-yolov7_path = "/Users/witsarut/Downloads/Tracking/SMILEtrack/Citysurvey_api/yolov7"
-if os.path.exists(yolov7_path):
-    sys.path.insert(0, yolov7_path)
-else:
-    print(f"Error: YOLOv7 directory not found at {yolov7_path}")
-    sys.exit(1)
-
-# Import YOLOv7 modules
-try:
-    from models.yolo import Model
-    from models.experimental import attempt_load
-    from utils.general import non_max_suppression
-    print("Successfully imported YOLOv7 modules")
-except ImportError as e:
-    print(f"Error importing YOLOv7 modules: {e}")
-    print("Make sure the YOLOv7 repository is correctly installed")
-    sys.exit(1)
-
-def convert_pt_to_torchscript(pt_path, output_path):
-    print(f"Loading model from {pt_path}")
+
+CALIB_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def letterbox(img, new_size=640, color=(114, 114, 114)):
+    """Resize ``img`` keeping its aspect ratio and pad it to ``new_size`` square, as YOLOv7's letterbox does."""
+    import cv2
+    h, w = img.shape[:2]
+    r = min(new_size / h, new_size / w)
+    new_w, new_h = int(round(w * r)), int(round(h * r))
+    if (new_w, new_h) != (w, h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    dw, dh = (new_size - new_w) / 2, (new_size - new_h) / 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+
+
+class CalibrationImages(torch.utils.data.Dataset):
+    """
+    Calibration images as 3xHxW float tensors in [0, 1], read from disk on access.
+    
+    Images are letterboxed like YOLOv7's inference preprocessing so the
+    observed ranges match deployment, and only one image is held in memory
+    at a time. Falls back to seeded random tensors (with a loud warning) when
+    no images are available: random calibration ranges noticeably hurt INT8
+    accuracy.
+    """
+    
+    def __init__(self, calib_dir, num_images=200, input_size=640):
+        self.input_size = input_size
+        self.paths = []
+        if calib_dir and os.path.isdir(calib_dir):
+            import cv2
+            paths = sorted(p for p in glob.glob(os.path.join(calib_dir, '*'))
+                           if p.lower().endswith(CALIB_EXTENSIONS))
+            # Only the file header is checked here; the pixels are read on access
+            for path in paths:
+                if len(self.paths) == num_images:
+                    break
+                if cv2.haveImageReader(path):
+                    self.paths.append(path)
+                else:
+                    print(f"Skipping unreadable calibration image {path}")
+        self.num_images = len(self.paths) or num_images
+        
+        if self.paths:
+            print(f"Calibrating on {len(self.paths)} images from {calib_dir}")
+        else:
+            print("=" * 70)
+            print(f"WARNING: no calibration images found in {calib_dir!r}")
+            print("WARNING: calibrating INT8 model on RANDOM data, expect degraded accuracy")
+            print("=" * 70)
+    
+    def __len__(self):
+        return self.num_images
+    
+    def __getitem__(self, index):
+        # Plain iteration stops at IndexError rather than consulting __len__
+        if not 0 <= index < self.num_images:
+            raise IndexError(index)
+        if not self.paths:
+            generator = torch.Generator().manual_seed(index)
+            return torch.rand((3, self.input_size, self.input_size), generator=generator)
+        
+        import cv2
+        path = self.paths[index]
+        img = cv2.imread(path)
+        if img is None:
+            raise ValueError(f"Unreadable calibration image {path}")
+        img = cv2.cvtColor(letterbox(img, self.input_size), cv2.COLOR_BGR2RGB)
+        return torch.from_numpy(img).permute(2, 0, 1).float().div(255.0)
+
+
+class FxTraceableModel(torch.nn.Module):
+    """
+    Call the YOLOv7 model with its default ``augment``/``profile`` arguments.
+    
+    FX symbolically traces every argument of the root ``forward``, so tracing
+    ``Model.forward(x, augment=False, profile=False)`` directly turns the flags
+    into proxies that cannot drive its ``if`` statements.
+    """
+    
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    
+    def forward(self, x):
+        return self.model(x)
+
+
+def export_int8(model, dummy_input, output_path, wrapper_options, calib_dir=None, calib_images=200, freeze=True):
+    """
+    Save a post-training-quantized INT8 model as a separate ``.int8.ts`` artifact.
+    
+    YOLOv7 uses functional adds/concats that eager-mode quantization cannot
+    handle, so FX graph mode is used. The detection heads are kept in float
+    (non-traceable) since their grid decoding is shape-dependent Python.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    
+    # FBGEMM on x86, QNNPACK on ARM
+    engine = 'qnnpack' if platform.machine().lower() in ('arm64', 'aarch64') else 'fbgemm'
+    torch.backends.quantized.engine = engine
+    print(f"Quantizing to INT8 with the {engine} backend")
+    
+    head_classes = list({type(m) for m in model.modules() if type(m).__name__.endswith('Detect')})
+    prepare_config = PrepareCustomConfig().set_non_traceable_module_classes(head_classes)
+    
+    float_model = FxTraceableModel(copy.deepcopy(model)).eval()
+    prepared = prepare_fx(float_model, get_default_qconfig_mapping(engine),
+                          example_inputs=(dummy_input,), prepare_custom_config=prepare_config)
+    
+    # Calibrate observers (no_grad rather than inference_mode: observers resize
+    # and update their buffers in place, which must stay usable by convert_fx)
+    with torch.no_grad():
+        for image in CalibrationImages(calib_dir, calib_images, dummy_input.shape[-1]):
+            prepared(image.unsqueeze(0))
+    
+    quantized = convert_fx(prepared)
+    
+    int8_path = str(Path(output_path).with_suffix('.int8.ts'))
+    scripted_int8 = script_wrapper(quantized, dummy_input, wrapper_options)
+    # optimize_for_inference targets float MKLDNN kernels, so only freeze here
+    save_torchscript(scripted_int8, dummy_input, int8_path, freeze=freeze, optimize=False)
+    print(f"INT8 TorchScript model saved to {int8_path}")
+    return True
+
+
+def file_digest(path, chunk_size=64 * 1024):
+    """BLAKE2b digest of a file, streamed in 64 KiB chunks so the weights aren't read into RAM at once."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def conversion_cache_key(model_path, **options):
+    """Cache key covering the input weights, the conversion options and the PyTorch version."""
+    knobs = '-'.join(f"{name}={options[name]}" for name in sorted(options))
+    return f"{file_digest(model_path)}-{knobs}-torch={torch.__version__}"
+
+
+def expected_artifacts(output_path, formats, memory_format, precision, quant, backend):
+    """Paths of every artifact a conversion with these options writes (the optional FP16 ONNX copy aside)."""
+    suffixes = []
+    if 'ts' in formats:
+        suffixes.append('.ts')
+        if memory_format == 'both':
+            suffixes.append('.nchw.ts')
+    if 'onnx' in formats:
+        suffixes.append('.onnx')
+    if precision != 'fp32':
+        suffixes.append(PRECISION_VARIANTS[precision][1])
+    if quant == 'int8':
+        suffixes.append('.int8.ts')
+    if backend == 'trt':
+        suffixes.append('.trt.fp16.ts')
+        if quant == 'int8':
+            suffixes.append('.trt.int8.ts')
+    # The TorchScript model keeps the output path as given, whatever its suffix
+    return [output_path if suffix == '.ts' else str(Path(output_path).with_suffix(suffix))
+            for suffix in suffixes]
+
+
+def is_cached(output_path, artifact_paths, key):
+    """True if all ``artifact_paths`` exist and the ``.meta.json`` side-car next to ``output_path`` records ``key``."""
+    meta_path = Path(output_path).with_suffix('.meta.json')
+    if not (meta_path.exists() and all(os.path.exists(p) for p in artifact_paths)):
+        return False
     try:
-        # Load the YOLOv7 model using the correct approach
-        with torch.serialization.safe_globals(['models.yolo.Model']):
-            # First try with attempt_load (preferred YOLOv7 way)
+        with open(meta_path) as f:
+            return json.load(f).get('key') == key
+    except (OSError, ValueError):
+        return False
+
+
+def clear_cache_meta(output_path):
+    """Remove the ``.meta.json`` side-car, so a conversion that fails part-way is never reported as cached."""
+    Path(output_path).with_suffix('.meta.json').unlink(missing_ok=True)
+
+
+def write_cache_meta(output_path, key):
+    """Record the cache key of a successful conversion in the ``.meta.json`` side-car."""
+    with open(Path(output_path).with_suffix('.meta.json'), 'w') as f:
+        json.dump({'key': key}, f)
+
+
+def export_tensorrt(model, dummy_input, output_path, wrapper_options, int8=False, calib_dir=None,
+                    calib_images=200):
+    """
+    Compile the frozen TorchScript model with Torch-TensorRT for CUDA deployment.
+    
+    Always writes a ``.trt.fp16.ts`` engine; with ``int8`` an additional
+    ``.trt.int8.ts`` engine is calibrated on the same images as the PTQ export.
+    Returns False when CUDA or torch_tensorrt is unavailable, which fails the conversion.
+    """
+    if not torch.cuda.is_available():
+        print("Cannot export TensorRT engines: CUDA is not available")
+        return False
+    try:
+        import torch_tensorrt
+    except ImportError as e:
+        print(f"Cannot export TensorRT engines: {e}")
+        return False
+    
+    device = torch.device('cuda')
+    shape = tuple(dummy_input.shape)
+    
+    # FP16: cast the model and input together, as in export_reduced_precision
+    half_model = copy.deepcopy(model).to(device).half()
+    materialize_detect_grids(half_model, shape[-1], dtype=torch.half, device=device)
+    half_input = dummy_input.to(device).half()
+    frozen = torch.jit.freeze(script_wrapper(half_model, half_input, wrapper_options))
+    compiled = torch_tensorrt.compile(frozen, inputs=[torch_tensorrt.Input(shape, dtype=torch.half)],
+                                      enabled_precisions={torch.half}, truncate_long_and_double=True)
+    fp16_path = str(Path(output_path).with_suffix('.trt.fp16.ts'))
+    torch.jit.save(compiled, fp16_path)
+    print(f"TensorRT FP16 model saved to {fp16_path}")
+    
+    if int8:
+        gpu_model = copy.deepcopy(model).to(device)
+        materialize_detect_grids(gpu_model, shape[-1], device=device)
+        gpu_input = dummy_input.to(device)
+        frozen = torch.jit.freeze(script_wrapper(gpu_model, gpu_input, wrapper_options))
+        
+        calib_loader = torch.utils.data.DataLoader(CalibrationImages(calib_dir, calib_images, shape[-1]),
+                                                   batch_size=1)
+        calibrator = torch_tensorrt.ptq.DataLoaderCalibrator(
+            calib_loader, use_cache=False,
+            algo_type=torch_tensorrt.ptq.CalibrationAlgo.ENTROPY_CALIBRATION_2, device=device)
+        compiled = torch_tensorrt.compile(frozen, inputs=[torch_tensorrt.Input(shape, dtype=torch.float)],
+                                          enabled_precisions={torch.float, torch.half, torch.int8},
+                                          calibrator=calibrator, truncate_long_and_double=True)
+        int8_path = str(Path(output_path).with_suffix('.trt.int8.ts'))
+        torch.jit.save(compiled, int8_path)
+        print(f"TensorRT INT8 model saved to {int8_path}")
+    return True
+
+
+def convert_model(model_path, output_path, include_nms=False, conf_thresh=0.25, iou_thresh=0.45,
+                  out_format=None, freeze=True, optimize=True, precision='fp32', quant='none',
+                  calib_dir=None, calib_images=200, formats=('ts',), memory_format='both',
+                  backend='cpu', force=False):
+    """
+    Convert a YOLOv7 .pt model to TorchScript (and the requested extra artifacts).
+    
+    Args:
+        model_path: Path to the .pt model file
+        output_path: Path for saving the TorchScript model
+        include_nms: Bake confidence filtering and NMS into the graph ('nms' mode)
+        conf_thresh: Confidence threshold for detections (NMS mode)
+        iou_thresh: IoU threshold for NMS (NMS mode)
+        out_format: Box format, 'xyxy' or 'xywh' (default: 'xyxy' with NMS, else 'xywh')
+        freeze: Whether to freeze the TorchScript module before saving
+        optimize: Whether to run optimize_for_inference and smoke-test the frozen module
+        precision: Also export a 'fp16' or 'bf16' variant next to the FP32 model
+        quant: 'int8' to also export a post-training-quantized model
+        calib_dir: Directory of calibration images for INT8 quantization
+        calib_images: Number of calibration images to use
+        formats: Output formats to write ('ts' and/or 'onnx')
+        memory_format: Layout of the traced graph: 'nhwc', 'nchw' or 'both'
+        backend: 'trt' to also compile Torch-TensorRT engines
+        force: Reconvert even if the cached output is up to date
+    """
+    if out_format is None:
+        out_format = 'xyxy' if include_nms else 'xywh'
+    wrapper_options = dict(include_nms=include_nms, conf_thresh=conf_thresh, iou_thresh=iou_thresh,
+                           out_format=out_format)
+    
+    # Skip the whole conversion if the weights and options are unchanged
+    key = conversion_cache_key(model_path, freeze=freeze, optimize=optimize, precision=precision, quant=quant,
+                               calib_dir=calib_dir, calib_images=calib_images, formats=','.join(formats),
+                               memory_format=memory_format, backend=backend, **wrapper_options)
+    artifacts = expected_artifacts(output_path, formats, memory_format, precision, quant, backend)
+    if not force and is_cached(output_path, artifacts, key):
+        print(f"{', '.join(artifacts)} up to date, skipping conversion")
+        return True
+    # Invalidate the previous conversion before any of its artifacts is overwritten;
+    # the meta is only written back once every requested export has succeeded
+    clear_cache_meta(output_path)
+    
+    print(f"Loading model from {model_path}")
+    if not setup_yolo_import_path(model_path):
+        return False
+    try:
+        model = load_yolo_model(model_path)
+        print("Loaded model")
+    except Exception as e:
+        print(f"Failed to load model: {e}")
+        return False
+    
+    # load_yolo_model returns a float32 model in eval mode; reduced-precision
+    # variants cast the model and the input together in export_reduced_precision.
+    # Use the channels_last layout MKLDNN convolutions prefer unless only NCHW was requested
+    layout = MEMORY_FORMATS['nchw' if memory_format == 'nchw' else 'nhwc']
+    model = model.to(memory_format=layout)
+    
+    # Create wrapped model that will produce the desired output format
+    wrapped_model = YoloExportWrapper(model, **wrapper_options).eval()
+    
+    # Tracing only needs the shape, so the input is left uninitialized and
+    # reused for every trace; it is allocated in the model's layout so the
+    # captured graph uses the same strides
+    dummy_input = torch.empty((1, 3, 640, 640), dtype=torch.float32, memory_format=layout)
+    
+    # Initialize the lazily built detection grids; only fall back to a full
+    # warm-up forward pass if no detection head was found
+    if not materialize_detect_grids(model, dummy_input.shape[-1]):
+        with torch.inference_mode():
             try:
-                model = attempt_load(pt_path, map_location=torch.device('cpu'))
-                print("Model loaded using attempt_load")
+                wrapped_model(dummy_input)
             except Exception as e:
-                print(f"attempt_load failed, trying direct load: {e}")
-                # Fallback to direct loading
-                checkpoint = torch.load(pt_path, map_location=torch.device('cpu'), weights_only=False)
-        
-        # Extract the actual model if using direct load
-        if 'model' not in locals():  # If model wasn't set by attempt_load
-            if isinstance(checkpoint, dict):
-                if 'model' in checkpoint:
-                    model = checkpoint['model']
-                elif 'ema' in checkpoint:
-                    model = checkpoint['ema']
-                else:
-                    print("Error: Checkpoint doesn't contain model or EMA")
-                    return False
-            else:
-                model = checkpoint
-        
-        # Convert model to float32 precision to avoid "expected scalar type Float but found Half" error
-        model = model.to(torch.float32)
-        
-        # Set to evaluation mode
-        model.eval()
-        
-        # Create a wrapper class to handle the YOLOv7 model outputs
-        class YOLOv7Wrapper(torch.nn.Module):
-            def __init__(self, model):
-                super().__init__()
-                self.model = model
-                # Set model to inference mode
-                self.model.eval()
-
-            def forward(self, x):
-                # YOLOv7 inference returns different formats
-                # This wrapper ensures consistent output
-                out = self.model(x)
-                if isinstance(out, tuple):
-                    return out[0]  # Return only first element (detections)
-                return out
-
-        # Wrap the model for consistent output
-        wrapper_model = YOLOv7Wrapper(model)
-        
-        # Run once to initialize all parameters
-        dummy_input = torch.zeros((1, 3, 640, 640), device='cpu')
-        with torch.no_grad():
-            _ = wrapper_model(dummy_input)
-        
-        # Trace the model
-        traced_model = torch.jit.trace(wrapper_model, dummy_input)
-        
-        # Save the TorchScript model
-        traced_model.save(output_path)
-        print(f"TorchScript model saved to {output_path}")
+                print(f"Error during warm-up run: {e}")
+                import traceback
+                traceback.print_exc()
+                return False
+    
+    # Convert to the requested formats
+    try:
+        if 'ts' in formats:
+            print("Converting to TorchScript...")
+            script_model = script_wrapper(model, dummy_input, wrapper_options)
+            test_run(script_model, dummy_input)
+            
+            # Freeze, optimize, smoke-test and save the TorchScript model
+            save_torchscript(script_model, dummy_input, output_path, freeze=freeze, optimize=optimize)
+            print(f"Model saved to {output_path}")
+            
+            # During the NHWC transition also ship an NCHW graph
+            if memory_format == 'both':
+                nchw_path = str(Path(output_path).with_suffix('.nchw.ts'))
+                nchw_input = dummy_input.contiguous()
+                nchw_model = copy.deepcopy(model).to(memory_format=torch.contiguous_format)
+                script_model = script_wrapper(nchw_model, nchw_input, wrapper_options)
+                test_run(script_model, nchw_input)
+                save_torchscript(script_model, nchw_input, nchw_path, freeze=freeze, optimize=optimize)
+                print(f"NCHW model saved to {nchw_path}")
+        
+        if 'onnx' in formats:
+            print("Converting to ONNX...")
+            export_onnx(script_wrapper(model, dummy_input, wrapper_options), dummy_input, output_path)
+        
+        # Emit the reduced-precision artifact alongside the FP32 one
+        if precision != 'fp32' and not export_reduced_precision(model, dummy_input, output_path, precision,
+                                                                wrapper_options, freeze=freeze,
+                                                                optimize=optimize):
+            print(f"Error: the requested {precision} variant was not exported")
+            return False
+        
+        # Keep the INT8 model in its own file
+        if quant == 'int8' and not export_int8(model, dummy_input, output_path, wrapper_options,
+                                               calib_dir=calib_dir, calib_images=calib_images, freeze=freeze):
+            print("Error: the requested INT8 model was not exported")
+            return False
+        
+        # GPU engines; --quant int8 also selects the INT8 TensorRT engine
+        if backend == 'trt' and not export_tensorrt(model, dummy_input, output_path, wrapper_options,
+                                                    int8=(quant == 'int8'), calib_dir=calib_dir,
+                                                    calib_images=calib_images):
+            print("Error: --backend trt was requested but the TensorRT export could not run")
+            return False
+        
+        write_cache_meta(output_path, key)
         return True
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Error during conversion: {e}")
+        import traceback
+        traceback.print_exc()
         return False
 
+
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python convert_model.py <input_pt_file> <output_torchscript_file>")
-        sys.exit(1)
+    # Options shared by both modes
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("input_file", help="Path to .pt model file")
+    common.add_argument("output_file", help="Path for saving TorchScript model")
+    common.add_argument("--freeze", action=argparse.BooleanOptionalAction, default=True,
+                        help="Freeze the TorchScript module before saving (default: on)")
+    common.add_argument("--optimize", action=argparse.BooleanOptionalAction, default=True,
+                        help="Run optimize_for_inference and check the frozen module runs on the "
+                             "fixed 1x3x640x640 input (does not speed up the first call at "
+                             "deployment) (default: on)")
+    common.add_argument("--formats", type=parse_formats, default=["ts"],
+                        help="Comma-separated output formats: ts, onnx (default: ts)")
+    common.add_argument("--memory-format", choices=["nhwc", "nchw", "both"], default="both",
+                        help="Layout of the traced graph; 'both' saves NHWC to the output path "
+                             "and an NCHW copy as .nchw.ts (default: both)")
+    common.add_argument("--precision", choices=["fp32", "fp16", "bf16"], default="fp32",
+                        help="Also export a reduced-precision variant (.fp16.ts / .bf16.ts) "
+                             "next to the FP32 model")
+    common.add_argument("--quant", choices=["none", "int8"], default="none",
+                        help="Also export a post-training-quantized INT8 model (.int8.ts)")
+    common.add_argument("--calib-dir", type=str, default=None,
+                        help="Directory of calibration images for INT8 quantization")
+    common.add_argument("--calib-images", type=int, default=200,
+                        help="Number of calibration images to use (default: 200)")
+    common.add_argument("--backend", choices=["cpu", "trt"], default="cpu",
+                        help="Also compile Torch-TensorRT engines (.trt.fp16.ts, plus .trt.int8.ts "
+                             "with --quant int8); requires CUDA and torch_tensorrt")
+    common.add_argument("--force", action="store_true",
+                        help="Reconvert even if the cached output matches the input and options")
+    
+    parser = argparse.ArgumentParser(description="Convert a YOLOv7 .pt model to TorchScript")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    raw_parser = subparsers.add_parser("raw", parents=[common],
+                                       help="Export the decoded predictions [batch, anchors, 5 + classes]")
+    raw_parser.add_argument("--out-format", choices=["xywh", "xyxy"], default="xywh",
+                            help="Box format of the predictions (default: xywh)")
+    nms_parser = subparsers.add_parser("nms", parents=[common],
+                                       help="Export post-processed [x1, y1, x2, y2, conf, class_id] detections")
+    nms_parser.add_argument("--conf", type=float, default=0.25, help="Confidence threshold")
+    nms_parser.add_argument("--iou", type=float, default=0.45, help="IoU threshold for NMS")
+    nms_parser.add_argument("--out-format", choices=["xyxy", "xywh"], default="xyxy",
+                            help="Box format of the detections (default: xyxy)")
     
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
+    args = parser.parse_args()
     
-    if not os.path.exists(input_file):
-        print(f"Error: Input file {input_file} does not exist")
+    if not os.path.exists(args.input_file):
+        print(f"Error: Input file {args.input_file} does not exist")
         sys.exit(1)
     
-    if convert_pt_to_torchscript(input_file, output_file):
-        print("Conversion successful!")
+    # Convert the model
+    include_nms = args.mode == "nms"
+    success = convert_model(args.input_file, args.output_file, include_nms=include_nms,
+                            conf_thresh=args.conf if include_nms else 0.25,
+                            iou_thresh=args.iou if include_nms else 0.45,
+                            out_format=args.out_format, freeze=args.freeze, optimize=args.optimize,
+                            precision=args.precision, quant=args.quant, calib_dir=args.calib_dir,
+                            calib_images=args.calib_images, formats=args.formats,
+                            memory_format=args.memory_format, backend=args.backend, force=args.force)
+    
+    if success:
+        print("Conversion completed successfully!")
     else:
         print("Conversion failed.")
-        sys.exit(1) 
\ No newline at end of file
+        sys.exit(1)